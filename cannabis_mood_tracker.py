@@ -2,15 +2,33 @@ import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 import pandas as pd
-from datetime import datetime
-from openai import OpenAI
+import numpy as np
+from numba import vectorize
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from openai.types.chat import ChatCompletion
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import os
+import io
+import glob
 import json
+import time
+import asyncio
+import sqlite3
+import re
+import functools
+import operator
+from contextlib import closing
 import streamlit as st
 
 # OpenAI API key
 api_key = os.getenv('OPENAI_API_KEY')
 
+# Persistent cache of LLM interpretations, keyed by (metric_name, raw value)
+METRIC_CACHE_DB = "metric_cache.sqlite3"
+
 @st.cache_resource
 def initialize_firebase():
     if not firebase_admin._apps:
@@ -25,13 +43,65 @@ def initialize_firebase():
             raise ValueError("Firebase credentials not found in environment variables")
     return firestore.client()
 
+@st.cache_resource
+def get_openai_client():
+    # One client for the whole app so its connection pool is reused across calls
+    return OpenAI(api_key=api_key)
+
+# Small, deterministic model settings: both tasks only need a short JSON object back
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 64  # plenty of headroom so the JSON is never cut off
+
+def completion_content(chat):
+    """Return the reply text of a chat completion, or None if it was cut off or refused."""
+    choice = chat.choices[0]
+    if choice.message.refusal:
+        print(f"Warning: OpenAI refused the request: {choice.message.refusal}")
+        return None
+    if choice.finish_reason != "stop":
+        print(f"Warning: OpenAI reply ended with finish_reason '{choice.finish_reason}'")
+        return None
+    return choice.message.content
+
+def json_schema_format(name, field, schema):
+    """Structured-output response_format for a single required numeric field."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {field: schema},
+                "required": [field],
+                "additionalProperties": False
+            }
+        }
+    }
+
+CANNABIS_RESPONSE_FORMAT = json_schema_format("cannabis_grams", "grams", {"type": "number", "minimum": 0})
+MOOD_RESPONSE_FORMAT = json_schema_format("mood_score", "score", {"type": "integer", "minimum": 1, "maximum": 5})
+
+# Inputs that can be interpreted without the LLM
+NO_USE_WORDS = {"none", "zero", "nothing", "no", "nope"}
+GRAMS_PATTERN = re.compile(r"^(\d*\.?\d+)\s*(?:g|gs|gram|grams)?$")
+SCORE_PATTERN = re.compile(r"^(\d*\.?\d+)(?:\s*/\s*5)?$")
+
 class CannabisMetricAgent:
     def __init__(self):
-        self.brain = OpenAI(api_key=api_key)
         self.role = "Cannabis Use Metric Interpreter"
 
-    def process_metric(self, metric_value):
-        print(f"Processing cannabis metric: {metric_value}")
+    def fast_path(self, metric_value):
+        """Return the grams for plain numbers, gram amounts and "none"-style inputs, else None."""
+        text = str(metric_value).strip().lower()
+        if text in NO_USE_WORDS:
+            return 0.0
+        match = GRAMS_PATTERN.match(text)
+        if match:
+            return float(match.group(1))
+        return None
+
+    def build_request(self, metric_value):
         prompt = f"""
         Task: Convert the given cannabis use amount to a numerical value in grams.
 
@@ -44,37 +114,50 @@ class CannabisMetricAgent:
         - For qualitative descriptions, estimate a reasonable amount in grams.
         - If an edible with milligrams is specified, use the following conversion: 10 mg gummy == 0.5 g cannabis.
 
-        Return only the numerical value as a float, with no additional text or explanation.
+        Return the amount in grams as the "grams" field.
         """
 
-        print("Sending request to OpenAI API for cannabis metric...")
-        chat = self.brain.chat.completions.create(
-            model="gpt-4",
-            messages=[
+        return {
+            "model": MODEL,
+            "messages": [
                 {"role": "system", "content": self.role},
                 {"role": "user", "content": prompt}
-            ]
-        )
+            ],
+            "max_tokens": MAX_TOKENS,
+            "temperature": 0,
+            "logprobs": False,
+            "response_format": CANNABIS_RESPONSE_FORMAT
+        }
 
-        response = chat.choices[0].message.content.strip()
+    def parse_response(self, response):
+        response = (response or "").strip()
         print(f"Received response from OpenAI API for cannabis metric: {response}")
-        
-        try:
-            result = float(response)
-            print(f"Converted cannabis metric to: {result} grams")
-        except ValueError:
-            result = 0.0
-            print(f"Warning: Couldn't convert '{response}' to a float. Defaulting to 0.0 grams.")
 
+        # The schema guarantees {"grams": <number >= 0>}; empty or malformed replies count as failed
+        if not response:
+            print("Warning: Empty response for cannabis metric.")
+            return None
+
+        try:
+            result = float(json.loads(response)["grams"])
+        except (ValueError, KeyError, TypeError):
+            print(f"Warning: Couldn't parse '{response}' as a cannabis metric.")
+            return None
+        print(f"Converted cannabis metric to: {result} grams")
         return result
 
 class MoodMetricAgent:
     def __init__(self):
-        self.brain = OpenAI(api_key=api_key)
         self.role = "Mood Metric Interpreter"
 
-    def process_metric(self, metric_value):
-        print(f"Processing mood metric: {metric_value}")
+    def fast_path(self, metric_value):
+        """Return the score for inputs that are already numeric (e.g. "4" or "4/5"), else None."""
+        match = SCORE_PATTERN.match(str(metric_value).strip())
+        if match:
+            return max(1, min(5, int(float(match.group(1)))))
+        return None
+
+    def build_request(self, metric_value):
         prompt = f"""
         Task: Convert the given mood description to a numerical score from 1 to 5.
 
@@ -88,39 +171,80 @@ class MoodMetricAgent:
         - If the input is already a number between 1 and 5, return that number
         - For qualitative descriptions, estimate the most appropriate score
 
-        Return only the numerical value as an integer from 1 to 5, with no additional text or explanation.
+        Return the score as the "score" field.
         """
 
-        print("Sending request to OpenAI API for mood metric...")
-        chat = self.brain.chat.completions.create(
-            model="gpt-4",
-            messages=[
+        return {
+            "model": MODEL,
+            "messages": [
                 {"role": "system", "content": self.role},
                 {"role": "user", "content": prompt}
-            ]
-        )
+            ],
+            "max_tokens": MAX_TOKENS,
+            "temperature": 0,
+            "logprobs": False,
+            "response_format": MOOD_RESPONSE_FORMAT
+        }
 
-        response = chat.choices[0].message.content.strip()
+    def parse_response(self, response):
+        response = (response or "").strip()
         print(f"Received response from OpenAI API for mood metric: {response}")
-        
-        try:
-            result = int(float(response))
-            result = max(1, min(5, result))  # Ensure the result is between 1 and 5
-            print(f"Converted mood metric to score: {result}")
-        except ValueError:
-            result = 3  # Default to neutral mood if conversion fails
-            print(f"Warning: Couldn't convert '{response}' to an integer. Defaulting to neutral mood (3).")
 
+        # The schema guarantees {"score": <integer 1..5>}; empty or malformed replies count as failed
+        if not response:
+            print("Warning: Empty response for mood metric.")
+            return None
+
+        try:
+            result = int(json.loads(response)["score"])
+        except (ValueError, KeyError, TypeError):
+            print(f"Warning: Couldn't parse '{response}' as a mood metric.")
+            return None
+        print(f"Converted mood metric to score: {result}")
         return result
 
+def _metric_cache():
+    conn = sqlite3.connect(METRIC_CACHE_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS metric_cache "
+        "(metric_name TEXT, raw TEXT, result REAL, PRIMARY KEY (metric_name, raw))"
+    )
+    return conn
+
+def get_cached_metrics(keys):
+    """Look up (metric_name, raw) pairs in the metric cache and return {(metric_name, raw): result} for hits."""
+    keys = list({(metric_name, str(raw)) for metric_name, raw in keys})
+    if not keys:
+        return {}
+    with closing(_metric_cache()) as conn:
+        # Join against a temporary table of the keys so the lookup is a single query
+        conn.execute("CREATE TEMP TABLE lookup (metric_name TEXT, raw TEXT)")
+        conn.executemany("INSERT INTO lookup (metric_name, raw) VALUES (?, ?)", keys)
+        rows = conn.execute(
+            "SELECT metric_cache.metric_name, metric_cache.raw, metric_cache.result "
+            "FROM metric_cache JOIN lookup USING (metric_name, raw)"
+        ).fetchall()
+    # Results are stored as REAL; mood scores are integers everywhere else
+    return {
+        (metric_name, raw): int(result) if metric_name == 'mood' else result
+        for metric_name, raw, result in rows
+    }
+
+def cache_metrics(results):
+    """Store {(metric_name, raw): result} in the metric cache."""
+    if not results:
+        return
+    with closing(_metric_cache()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO metric_cache (metric_name, raw, result) VALUES (?, ?, ?)",
+            [(metric_name, str(raw), result) for (metric_name, raw), result in results.items()]
+        )
+
 def calculate(metric_name, metric_value):
     print(f"Calculating metric: {metric_name}, value: {metric_value}")
-    if metric_name == 'cannabis_use':
-        agent = CannabisMetricAgent()
-        return agent.process_metric(metric_value)
-    elif metric_name == 'mood':
-        agent = MoodMetricAgent()
-        return agent.process_metric(metric_value)
+    if metric_name in METRIC_AGENTS:
+        # Same fast paths and cache as a full sync
+        return calculate_many([(metric_name, metric_value)])[0]
     else:
         # For financial metrics, we'll assume they're already numerical
         try:
@@ -129,10 +253,362 @@ def calculate(metric_name, metric_value):
             print(f"Warning: Couldn't convert '{metric_value}' to a float for {metric_name}. Returning 0.")
             return 0.0
 
-def get_user_data_as_dataframe(user_id, db):
+# Metrics that need an LLM to interpret free-text values
+METRIC_AGENTS = {
+    'cannabis_use': CannabisMetricAgent,
+    'mood': MoodMetricAgent
+}
+
+BATCH_POLL_INTERVAL = 10  # seconds between batch status checks
+MAX_CONCURRENT_REQUESTS = 10  # in-flight OpenAI requests for interactive loads
+
+def run_batch(client, requests):
+    """Submit {custom_id: chat.completions body} as one Batch API job and return {custom_id: content}."""
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        })
+        for custom_id, body in requests.items()
+    ]
+    batch_file = client.files.create(
+        file=("batch_input.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Submitted OpenAI batch {batch.id} with {len(lines)} requests")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id} status: {batch.status}")
+
+    results = {}
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"Warning: Batch {batch.id} ended with status '{batch.status}'. No results returned.")
+        return results
+
+    output = client.files.content(batch.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f"Warning: Batch request {record['custom_id']} failed: {record.get('error')}")
+            continue
+        content = completion_content(ChatCompletion.model_validate(response["body"]))
+        if content is not None:
+            results[record["custom_id"]] = content
+    return results
+
+# Only transient errors are retried; 4xx errors such as a rejected schema fail immediately
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential()
+)
+async def _complete(client, body):
+    chat = await client.chat.completions.create(**body)
+    # Truncated or refused replies repeat at temperature 0, so they are not retried here
+    return completion_content(chat)
+
+async def _classify(custom_id, body, client, sem):
+    async with sem:
+        try:
+            return custom_id, await _complete(client, body)
+        except Exception as e:
+            print(f"Warning: OpenAI request {custom_id} failed after retries: {e}")
+            return custom_id, None
+
+async def _run_concurrent(requests):
+    # One client for the whole fan-out so connections are reused. Its built-in retries are
+    # disabled so that _complete's retry policy is the only one.
+    async with AsyncOpenAI(api_key=api_key, max_retries=0) as client:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        results = await asyncio.gather(*[
+            _classify(custom_id, body, client, sem)
+            for custom_id, body in requests.items()
+        ])
+    return dict(results)
+
+def run_concurrent(requests):
+    """Send {custom_id: chat.completions body} as concurrent requests and return {custom_id: content}.
+
+    The content is None for requests that still failed after retries.
+    """
+    print(f"Sending {len(requests)} concurrent requests to OpenAI API...")
+    return asyncio.run(_run_concurrent(requests))
+
+@vectorize(['float64(float64)'])
+def clamp_mood_scores(score):
+    # Same as the mood fast path: truncate to an integer score in 1..5
+    return min(5.0, max(1.0, np.floor(score)))
+
+def calculate_numeric(metrics):
+    """Vectorized fast path for values that are already plain numbers; returns {index: result}."""
+    names = np.array([metric_name for metric_name, _ in metrics], dtype=object)
+    values = pd.to_numeric(
+        pd.Series([metric_value for _, metric_value in metrics], dtype=object), errors='coerce'
+    ).to_numpy(dtype=np.float64)
+    is_numeric = np.isfinite(values)
+    is_mood = names == 'mood'
+
+    mood = is_numeric & is_mood
+    values[mood] = clamp_mood_scores(values[mood])
+    # Grams can't be negative, matching the "minimum": 0 in the LLM response schema
+    cannabis = is_numeric & (names == 'cannabis_use')
+    values[cannabis] = np.maximum(values[cannabis], 0.0)
+
+    return {
+        idx: int(values[idx]) if is_mood[idx] else float(values[idx])
+        for idx in np.flatnonzero(is_numeric).tolist()
+    }
+
+def calculate_many(metrics, use_batch=False):
+    """Calculate a list of (metric_name, metric_value) pairs, sending all LLM metrics at once.
+
+    Values whose OpenAI request failed come back as None, so callers can leave them out and
+    retry on the next sync. By default the requests are fanned out concurrently, which suits interactive loads. Pass
+    use_batch=True to submit them as a single Batch API job instead (cheaper, but can take up to 24h).
+    """
+    results = [None] * len(metrics)
+    numeric = calculate_numeric(metrics)
+    cached = get_cached_metrics(
+        (metric_name, metric_value) for idx, (metric_name, metric_value) in enumerate(metrics)
+        if metric_name in METRIC_AGENTS and idx not in numeric
+    )
+    agents = {}
+    requests = {}
+    request_keys = {}
+    key_indices = {}
+
+    for idx, (metric_name, metric_value) in enumerate(metrics):
+        if idx in numeric:
+            results[idx] = numeric[idx]
+        elif metric_name in METRIC_AGENTS:
+            if metric_name not in agents:
+                agents[metric_name] = METRIC_AGENTS[metric_name]()
+            literal = agents[metric_name].fast_path(metric_value)
+            if literal is not None:
+                results[idx] = literal
+                continue
+            key = (metric_name, str(metric_value))
+            if key in cached:
+                results[idx] = cached[key]
+                continue
+            # Repeated raw values only need to be sent once
+            if key not in key_indices:
+                custom_id = f"{metric_name}:{idx}"
+                requests[custom_id] = agents[metric_name].build_request(metric_value)
+                request_keys[custom_id] = key
+                key_indices[key] = []
+            key_indices[key].append(idx)
+        else:
+            results[idx] = calculate(metric_name, metric_value)
+
+    if requests:
+        print(f"Reused {len(cached)} cached values, sending {len(requests)} requests to OpenAI")
+        if use_batch:
+            responses = run_batch(get_openai_client(), requests)
+        else:
+            responses = run_concurrent(requests)
+
+        new_results = {}
+        for custom_id, key in request_keys.items():
+            metric_name = key[0]
+            response = responses.get(custom_id)
+            if response is None:
+                # Failed requests stay None rather than falling back to a default value
+                print(f"Warning: No response for {metric_name} value '{key[1]}'. It will be retried on the next sync.")
+                result = None
+            else:
+                result = agents[metric_name].parse_response(response)
+            # Only real answers are cached; anything else is asked again next time
+            if result is not None:
+                new_results[key] = result
+            for idx in key_indices[key]:
+                results[idx] = result
+        cache_metrics(new_results)
+
+    return results
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# The only parts of the user document the dashboard reads
+STATE_FIELDS = [
+    'cannabis_use_since_last_update',
+    'mood',
+    'monthly_cashflow_income',
+    'monthly_cashflow_expenses',
+    'monthly_cashflow_savings',
+    'monthly_cashflow_savings_rate'
+]
+
+# Every event_type stored in the user data; kept categorical so filters and groupbys
+# work on integer codes instead of strings
+EVENT_TYPE_DTYPE = pd.CategoricalDtype([
+    'cannabis_use_since_last_update_raw',
+    'cannabis_use_since_last_update_grams',
+    'mood_raw',
+    'mood_score',
+    'monthly_cashflow_income',
+    'monthly_cashflow_expenses',
+    'monthly_cashflow_savings',
+    'monthly_cashflow_savings_rate'
+])
+
+def new_entries(entries, existing_idx, event_type):
+    """Return (dt, value) pairs from a {date: value} dict whose date isn't stored yet for event_type."""
+    dts = pd.to_datetime(list(entries), format=DATE_FORMAT)
+    have = existing_idx.get_level_values('dt')[existing_idx.get_level_values('event_type') == event_type]
+    need = dts.difference(have)
+    values = pd.Series(list(entries.values()), index=dts, dtype=object)
+    return zip(need.to_pydatetime(), values.loc[need])
+
+# User data is stored as a Parquet dataset partitioned by month, e.g.
+# user_<id>_data/year=2024/month=8/part-<timestamp>-0.parquet. Each sync only
+# writes its new rows, as one new file per month touched; once a month has more
+# than COMPACT_AFTER_FILES files they are merged into one. Reads filter on the
+# year/month partition keys, so months outside the requested range are never opened.
+# 'value' mixes raw text and numbers, so it is stored as strings; aggregation
+# converts it back with pd.to_numeric.
+USER_DATA_SCHEMA = pa.schema([
+    ('dt', pa.timestamp('ns')),
+    ('event_type', pa.dictionary(pa.int8(), pa.string())),
+    ('value', pa.string()),
+    ('year', pa.int16()),
+    ('month', pa.int8())
+])
+USER_DATA_PARTITIONING = ds.partitioning(
+    pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor="hive"
+)
+USER_DATA_COLUMNS = ['dt', 'event_type', 'value']
+COMPACT_AFTER_FILES = 8
+
+def compact_month(month_dir):
+    """Merge a month's part files into one once there are more than COMPACT_AFTER_FILES."""
+    files = sorted(glob.glob(os.path.join(month_dir, "part-*.parquet")))
+    if len(files) <= COMPACT_AFTER_FILES:
+        return
+    table = ds.dataset(files, format="parquet").to_table().sort_by("dt")
+    # Written under a hidden name (ignored by dataset reads) and moved into place
+    # before the old parts are removed, so no rows are ever missing
+    tmp_filename = os.path.join(month_dir, f".compact-{time.time_ns()}.parquet")
+    pq.write_table(table, tmp_filename, compression="zstd")
+    os.replace(tmp_filename, os.path.join(month_dir, f"part-{time.time_ns()}-0.parquet"))
+    for filename in files:
+        os.remove(filename)
+    print(f"Compacted {len(files)} files in {month_dir}")
+
+def user_data_dir(user_id):
+    return f"user_{user_id}_data"
+
+def append_user_data(user_id, df):
+    """Write new rows to the user's dataset, touching only the months they fall in."""
+    df = df.assign(
+        value=df['value'].astype(str),
+        year=df['dt'].dt.year,
+        month=df['dt'].dt.month
+    )
+    table = pa.Table.from_pandas(df, schema=USER_DATA_SCHEMA, preserve_index=False)
+    ds.write_dataset(
+        table,
+        user_data_dir(user_id),
+        format="parquet",
+        partitioning=USER_DATA_PARTITIONING,
+        # A fresh file name per write so earlier parts in the same month are kept
+        basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd")
+    )
+
+    for year, month in df[['year', 'month']].drop_duplicates().itertuples(index=False):
+        compact_month(os.path.join(user_data_dir(user_id), f"year={year}", f"month={month}"))
+
+def load_user_data(user_id, start=None, end=None, columns=USER_DATA_COLUMNS, event_types=None):
+    """Read the user's stored rows, optionally only those with start <= dt < end
+    and an event_type in event_types."""
+    data_dir = user_data_dir(user_id)
+    if not os.path.isdir(data_dir):
+        return pd.DataFrame({
+            'dt': pd.Series(dtype='datetime64[ns]'),
+            'event_type': pd.Series(dtype=EVENT_TYPE_DTYPE),
+            'value': pd.Series(dtype=object)
+        })[columns]
+
+    # Partition predicates prune whole months; the dt predicates trim rows within them
+    filters = []
+    year, month = ds.field('year'), ds.field('month')
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters.append((year > start.year) | ((year == start.year) & (month >= start.month)))
+        filters.append(ds.field('dt') >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        last = end - pd.Timedelta(1, 'ns')
+        filters.append((year < last.year) | ((year == last.year) & (month <= last.month)))
+        filters.append(ds.field('dt') < end)
+    if event_types is not None:
+        filters.append(ds.field('event_type').isin(list(event_types)))
+    row_filter = functools.reduce(operator.and_, filters) if filters else None
+
+    dataset = ds.dataset(data_dir, format="parquet", partitioning=USER_DATA_PARTITIONING)
+    df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    if 'event_type' in df:
+        df['event_type'] = df['event_type'].astype(EVENT_TYPE_DTYPE)
+    # Parts are read in file order, so restore chronological order for the selected rows
+    return df.sort_values('dt', ignore_index=True, kind='stable')
+
+def load_latest_before(user_id, end, event_types, lookback_months=2):
+    """Latest stored row of each event type with dt < end.
+
+    Only the last lookback_months month partitions are read unless some event type
+    has no row there, in which case the older history is searched as well.
+    """
+    end = pd.Timestamp(end)
+    event_types = list(event_types)
+    recent_start = ((end - pd.Timedelta(1, 'ns')).to_period('M') - (lookback_months - 1)).start_time
+    df = load_user_data(user_id, start=recent_start, end=end, event_types=event_types)
+    missing = set(event_types) - set(df['event_type'].unique())
+    if missing:
+        older = load_user_data(user_id, end=recent_start, event_types=missing)
+        df = pd.concat([older, df], ignore_index=True)
+    return df.drop_duplicates('event_type', keep='last').reset_index(drop=True)
+
+def count_user_data(user_id):
+    """Number of rows stored for the user, read from Parquet metadata."""
+    data_dir = user_data_dir(user_id)
+    if not os.path.isdir(data_dir):
+        return 0
+    return ds.dataset(data_dir, format="parquet", partitioning=USER_DATA_PARTITIONING).count_rows()
+
+def migrate_legacy_user_data(user_id):
+    """Move a single-file Parquet or CSV history from older runs into the dataset."""
+    parquet_filename = f"user_{user_id}_data.parquet"
+    csv_filename = f"user_{user_id}_data.csv"
+    if os.path.exists(parquet_filename):
+        legacy_df = pd.read_parquet(parquet_filename)
+    elif os.path.exists(csv_filename):
+        legacy_df = pd.read_csv(csv_filename, parse_dates=['dt'])
+    else:
+        return
+    legacy_df['event_type'] = legacy_df['event_type'].astype(EVENT_TYPE_DTYPE)
+    append_user_data(user_id, legacy_df)
+    print(f"Migrated {len(legacy_df)} rows from legacy data file to {user_data_dir(user_id)}")
+
+def get_new_user_data_as_dataframe(user_id, db):
+    """Return the Firestore entries that are not stored locally yet, with processed values."""
     print(f"Fetching data for user: {user_id}")
     user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
+    # Only fetch the state sub-fields we use rather than the whole user document
+    user_doc = user_ref.get(field_paths=[f"state.{field}" for field in STATE_FIELDS])
     
     if not user_doc.exists:
         print(f"No document found for user: {user_id}")
@@ -154,48 +630,25 @@ def get_user_data_as_dataframe(user_id, db):
           f"{len(monthly_cashflow_income)} income entries, {len(monthly_cashflow_expenses)} expenses entries, "
           f"{len(monthly_cashflow_savings)} savings entries, and {len(monthly_cashflow_savings_rate)} savings rate entries")
     
-    # Load existing CSV data from local file
-    csv_filename = f"user_{user_id}_data.csv"
-    if os.path.exists(csv_filename):
-        existing_df = pd.read_csv(csv_filename, parse_dates=['dt'])
-        print(f"Loaded existing CSV from local file with {len(existing_df)} rows")
-    else:
-        existing_df = pd.DataFrame(columns=['dt', 'event_type', 'value'])
-        print("Starting with empty DataFrame.")
+    # Load the keys of the existing data from the local dataset
+    if not os.path.isdir(user_data_dir(user_id)):
+        migrate_legacy_user_data(user_id)
+    existing_df = load_user_data(user_id, columns=['dt', 'event_type'])
+    print(f"Loaded {len(existing_df)} existing rows from {user_data_dir(user_id)}")
 
-    df_data = []
-    
-    for date, use in cannabis_use.items():
-        dt = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-        if not ((existing_df['dt'] == dt) & (existing_df['event_type'] == 'cannabis_use_since_last_update_raw')).any():
-            print(f"Processing new cannabis use entry for date: {date}")
-            processed_value = calculate('cannabis_use', use)
-            df_data.append({
-                'dt': dt,
-                'event_type': 'cannabis_use_since_last_update_raw',
-                'value': use
-            })
-            df_data.append({
-                'dt': dt,
-                'event_type': 'cannabis_use_since_last_update_grams',
-                'value': processed_value
-            })
+    # (event_type, dt) pairs already on disk, used to find the new entries of each metric
+    existing_idx = existing_df.set_index(['event_type', 'dt']).index
+
+    # Collect every new entry first so LLM metrics can be calculated together
+    pending = []
+
+    for dt, use in new_entries(cannabis_use, existing_idx, 'cannabis_use_since_last_update_raw'):
+        print(f"Processing new cannabis use entry for date: {dt}")
+        pending.append((dt, 'cannabis_use', use))
     
-    for date, mood_value in mood.items():
-        dt = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-        if not ((existing_df['dt'] == dt) & (existing_df['event_type'] == 'mood_raw')).any():
-            print(f"Processing new mood entry for date: {date}")
-            processed_value = calculate('mood', mood_value)
-            df_data.append({
-                'dt': dt,
-                'event_type': 'mood_raw',
-                'value': mood_value
-            })
-            df_data.append({
-                'dt': dt,
-                'event_type': 'mood_score',
-                'value': processed_value
-            })
+    for dt, mood_value in new_entries(mood, existing_idx, 'mood_raw'):
+        print(f"Processing new mood entry for date: {dt}")
+        pending.append((dt, 'mood', mood_value))
     
     # Process financial metrics individually
     financial_metrics = [
@@ -206,46 +659,73 @@ def get_user_data_as_dataframe(user_id, db):
     ]
 
     for metric_name, metric_data in financial_metrics:
-        for date, value in metric_data.items():
-            dt = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-            if not ((existing_df['dt'] == dt) & (existing_df['event_type'] == metric_name)).any():
-                print(f"Processing new {metric_name} entry for date: {date}")
-                processed_value = calculate(metric_name, value)
-                df_data.append({
-                    'dt': dt,
-                    'event_type': metric_name,
-                    'value': processed_value
-                })
+        for dt, value in new_entries(metric_data, existing_idx, metric_name):
+            print(f"Processing new {metric_name} entry for date: {dt}")
+            pending.append((dt, metric_name, value))
+
+    processed_values = calculate_many([(metric_name, value) for _, metric_name, value in pending])
+
+    # Event types for the raw and processed rows of each LLM metric
+    llm_event_types = {
+        'cannabis_use': ('cannabis_use_since_last_update_raw', 'cannabis_use_since_last_update_grams'),
+        'mood': ('mood_raw', 'mood_score')
+    }
+
+    # Build the columns directly rather than a list of row dicts
+    dts = []
+    event_types = []
+    values = []
+    for (dt, metric_name, value), processed_value in zip(pending, processed_values):
+        if processed_value is None:
+            # Not stored, so the entry is still new (and retried) on the next sync
+            print(f"Skipping {metric_name} entry for date {dt}: its value could not be calculated")
+            continue
+        if metric_name in llm_event_types:
+            raw_event_type, processed_event_type = llm_event_types[metric_name]
+            dts += [dt, dt]
+            event_types += [raw_event_type, processed_event_type]
+            values += [value, processed_value]
+        else:
+            dts.append(dt)
+            event_types.append(metric_name)
+            values.append(processed_value)
     
-    new_df = pd.DataFrame(df_data)
+    new_df = pd.DataFrame({
+        'dt': np.array(dts, dtype='datetime64[ns]'),
+        'event_type': pd.Categorical(event_types, dtype=EVENT_TYPE_DTYPE),
+        'value': np.array(values, dtype=object)
+    })
     if not new_df.empty:
         new_df = new_df.sort_values('dt')
         print(f"Created DataFrame with {len(new_df)} new rows")
-        
-        # Combine existing and new data
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-        combined_df = combined_df.sort_values('dt')
-        print(f"Combined DataFrame now has {len(combined_df)} rows")
-        
-        return combined_df
     else:
         print("No new data to process")
-        return existing_df
+    return new_df
 
+@st.cache_data(ttl=300, show_spinner=False)
 def update_user_data(user_id):
+    """Store any new Firestore entries locally and return the stored row count, or None if there is no data.
+
+    Use load_user_data to read the rows for the range being displayed.
+    """
     db = initialize_firebase()
     print(f"Updating data for user: {user_id}")
-    df = get_user_data_as_dataframe(user_id, db)
-    if df is None or df.empty:
+    new_df = get_new_user_data_as_dataframe(user_id, db)
+    if new_df is None:
+        print(f"No data found for user {user_id}")
+        return None
+
+    # Only the new rows are written; existing months are left untouched
+    if not new_df.empty:
+        append_user_data(user_id, new_df)
+        print(f"Saved {len(new_df)} new rows to {user_data_dir(user_id)}")
+
+    row_count = count_user_data(user_id)
+    if row_count == 0:
         print(f"No data found for user {user_id}")
         return None
     
-    # Save to CSV locally
-    csv_filename = f"user_{user_id}_data.csv"
-    df.to_csv(csv_filename, index=False)
-    print(f"Data saved to CSV file: {csv_filename}")
-    
-    return df
+    return row_count
 
 def get_quantitative_metrics(df):
     return df[df['event_type'].isin([
@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
-from cannabis_mood_tracker import update_user_data, get_quantitative_metrics, initialize_firebase
+from pandas.api.types import is_datetime64_any_dtype
+from cannabis_mood_tracker import update_user_data, load_user_data, load_latest_before, get_quantitative_metrics, initialize_firebase
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
@@ -21,70 +22,104 @@ if 'OPENAI_API_KEY' not in os.environ:
 # Initialize Firebase using Streamlit's caching
 db = initialize_firebase()
 
-def aggregate_data(df, granularity):
-    # Convert 'dt' to datetime if it's not already
-    df['dt'] = pd.to_datetime(df['dt'])
-    
-    # Adjust granularity
+FINANCIAL_METRICS = ['monthly_cashflow_income', 'monthly_cashflow_expenses',
+                     'monthly_cashflow_savings', 'monthly_cashflow_savings_rate']
+
+# Each cached function keeps a handful of recent windows instead of every one ever viewed
+CACHE_MAX_ENTRIES = 16
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_quantitative_metrics(user_id, start_date, end_date, row_count):
+    # row_count is part of the cache key so newly stored rows invalidate cached windows
+    df = load_user_data(user_id, start=start_date, end=end_date)
+
+    # Financial metrics are only logged monthly, so carry in the latest row of each from
+    # before the window; aggregate_data forward-fills them into the visible periods
+    latest_financials = load_latest_before(user_id, start_date, FINANCIAL_METRICS)
+
+    return get_quantitative_metrics(pd.concat([latest_financials, df], ignore_index=True))
+
+def period_start(dt, granularity):
+    """Start of the granularity period each timestamp falls in."""
     if granularity == 'Hourly':
-        df['period'] = df['dt'].dt.floor('H')
+        return dt.dt.floor('H')
     elif granularity == 'Daily':
-        df['period'] = df['dt'].dt.floor('D')
+        return dt.dt.floor('D')
     elif granularity == 'Weekly':
-        df['period'] = df['dt'].to_period('W').apply(lambda r: r.start_time)
+        return dt.dt.to_period('W').dt.start_time
     elif granularity == 'Minutely':
-        df['period'] = df['dt'].dt.floor('T')
+        return dt.dt.floor('T')
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def mood_fill_value(user_id, granularity, row_count):
+    # Periods without a mood entry show the user's typical mood over their whole history,
+    # i.e. the mean of all per-period averages; only the mood rows' dt and value are read
+    moods = load_user_data(user_id, columns=['dt', 'value'], event_types=['mood_score'])
+    values = pd.to_numeric(moods['value'], errors='coerce')
+    return values.groupby(period_start(moods['dt'], granularity)).mean().mean()
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def aggregate_data(df, granularity, mood_fill):
+    # Work on a copy so the cached input frame is never modified
+    df = df.copy()
+
+    # Convert 'dt' to datetime if it's not already
+    if not is_datetime64_any_dtype(df['dt']):
+        df['dt'] = pd.to_datetime(df['dt'])
+    
+    # Adjust granularity
+    df['period'] = period_start(df['dt'], granularity)
     
-    # Separate dataframes for different metrics
+    # Output column and per-period aggregation for each metric
     metrics = {
-        'cannabis_use_since_last_update_grams': 'cannabis_grams',
-        'mood_score': 'mood_score',
-        'monthly_cashflow_income': 'monthly_cashflow_income',
-        'monthly_cashflow_expenses': 'monthly_cashflow_expenses',
-        'monthly_cashflow_savings': 'monthly_cashflow_savings',
-        'monthly_cashflow_savings_rate': 'monthly_cashflow_savings_rate'
+        'cannabis_use_since_last_update_grams': ('cannabis_grams', 'sum'),
+        'mood_score': ('mood_score', 'mean'),
+        'monthly_cashflow_income': ('monthly_cashflow_income', 'last'),
+        'monthly_cashflow_expenses': ('monthly_cashflow_expenses', 'last'),
+        'monthly_cashflow_savings': ('monthly_cashflow_savings', 'last'),
+        'monthly_cashflow_savings_rate': ('monthly_cashflow_savings_rate', 'last')
     }
-    
-    aggregated_dfs = []
-
-    for event_type, column_name in metrics.items():
-        metric_df = df[df['event_type'] == event_type]
-        
-        if not metric_df.empty:
-            metric_df['value'] = pd.to_numeric(metric_df['value'], errors='coerce')
-            
-            if event_type == 'cannabis_use_since_last_update_grams':
-                agg_df = metric_df.groupby('period')['value'].sum().reset_index()
-            elif event_type == 'mood_score':
-                agg_df = metric_df.groupby('period')['value'].mean().reset_index()
-            else:
-                agg_df = metric_df.groupby('period').last().reset_index()
-            
-            # Ensure we only have 'period' and 'value' columns
-            agg_df = agg_df[['period', 'value']]
-            agg_df.columns = ['dt', column_name]
-            aggregated_dfs.append(agg_df)
-        else:
-            # If no data for this metric, create an empty DataFrame with the correct columns
-            agg_df = pd.DataFrame(columns=['dt', column_name])
-            aggregated_dfs.append(agg_df)
-    
-    # Merge all aggregated dataframes
-    final_df = aggregated_dfs[0]
-    for df in aggregated_dfs[1:]:
-        final_df = pd.merge(final_df, df, on='dt', how='outer')
+    agg_map = {event_type: how for event_type, (_, how) in metrics.items()}
+
+    df = df[df['event_type'].isin(metrics)]
+    df = df.assign(value=pd.to_numeric(df['value'], errors='coerce'))
+    is_last = df['event_type'].isin([event_type for event_type, how in agg_map.items() if how == 'last'])
+
+    # Financial metrics only need the latest row of each period
+    latest = (
+        df[is_last]
+        .sort_values('dt', kind='stable')
+        .drop_duplicates(['period', 'event_type'], keep='last')
+        .set_index(['period', 'event_type'])['value']
+    )
+
+    # Cannabis is summed and mood averaged per period. Groups whose values are all
+    # non-numeric stay as NaN so their period is kept and filled below.
+    rolled_up = [
+        df[df['event_type'].isin([event_type for event_type, agg in agg_map.items() if agg == how])]
+        .groupby(['period', 'event_type'], observed=True)['value']
+        .agg(how)
+        for how in ('sum', 'mean')
+    ]
+
+    final_df = (
+        pd.concat([*rolled_up, latest])
+        .unstack(1)
+        .reindex(columns=list(metrics))
+        .rename(columns={event_type: column_name for event_type, (column_name, _) in metrics.items()})
+        .rename_axis(index='dt', columns=None)
+        .reset_index()
+    )
     
     # Sort by datetime
     final_df = final_df.sort_values('dt')
     
     # Replace NaN with appropriate values
     final_df['cannabis_grams'] = final_df['cannabis_grams'].fillna(0)
-    final_df['mood_score'] = final_df['mood_score'].fillna(final_df['mood_score'].mean())
+    final_df['mood_score'] = final_df['mood_score'].fillna(mood_fill)
     
     # For financial metrics, forward fill (use the last known value)
-    financial_columns = ['monthly_cashflow_income', 'monthly_cashflow_expenses', 
-                         'monthly_cashflow_savings', 'monthly_cashflow_savings_rate']
-    final_df[financial_columns] = final_df[financial_columns].ffill()
+    final_df[FINANCIAL_METRICS] = final_df[FINANCIAL_METRICS].ffill()
     
     return final_df
 
@@ -115,19 +150,13 @@ def main():
     user_id = "7172032887"
 
     # Update data
-    df = update_user_data(user_id)
+    row_count = update_user_data(user_id)
 
-    if df is not None:
-        # Get quantitative metrics
-        quant_df = get_quantitative_metrics(df)
-        
+    if row_count is not None:
         # Period granularity selection (default to Hourly)
         st.subheader("Select Period Granularity")
         granularity = st.selectbox("Granularity", ['Hourly', 'Minutely', 'Daily', 'Weekly'], index=0)
         
-        # Aggregate data based on the selected granularity
-        aggregated_df = aggregate_data(quant_df, granularity)
-        
         # Date range selection
         st.subheader("Select Date Range")
         end_date = datetime.now().date() + timedelta(days=1)
@@ -137,6 +166,18 @@ def main():
 
         # Adjust the filter to start from the next day after the selected start date
         adjusted_start_date = min_date + timedelta(days=1)
+
+        # Only load the selected date range, so aggregation works on the visible window.
+        # A visible week starting before max_date still covers its remaining days.
+        window_end = pd.Timestamp(max_date + timedelta(days=1))
+        if granularity == 'Weekly':
+            window_end = pd.Timestamp(max_date).to_period('W').end_time.normalize() + timedelta(days=1)
+        quant_df = load_quantitative_metrics(user_id, adjusted_start_date, window_end, row_count)
+
+        # Aggregate data based on the selected granularity, then drop the carried-in
+        # financial rows and any period (e.g. a week) that starts before the window
+        mood_fill = mood_fill_value(user_id, granularity, row_count)
+        aggregated_df = aggregate_data(quant_df, granularity, mood_fill)
         filtered_df = aggregated_df[(aggregated_df['dt'].dt.date >= adjusted_start_date) & (aggregated_df['dt'].dt.date <= max_date)]
 
         # Create line charts
@@ -144,13 +185,12 @@ def main():
         safe_plot(filtered_df, 'dt', 'mood_score', f"Average Mood Score Over Time (per {granularity.lower()})")
         
         st.subheader("Financial Metrics")
-        financial_metrics = ['monthly_cashflow_income', 'monthly_cashflow_expenses', 'monthly_cashflow_savings', 'monthly_cashflow_savings_rate']
-        for metric in financial_metrics:
+        for metric in FINANCIAL_METRICS:
             safe_plot(filtered_df, 'dt', metric, metric.replace('_', ' ').title())
 
         # Display raw data
         st.subheader("Raw Data")
-        st.write(quant_df)
+        st.write(quant_df[(quant_df['dt'].dt.date >= adjusted_start_date) & (quant_df['dt'].dt.date <= max_date)])
 
         # Display aggregated data
         st.subheader("Aggregated Data")